@@ -1,11 +1,26 @@
 import pandas as pd
+import plotly
 import plotly.express as px
+import plotly.utils
 import plotly.graph_objects as go
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output, State
+from flask import request
+import collections
+import cProfile
+import functools
+import hashlib
+import hmac
 import json
 import os
+import platform
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
 
 # --- 1. prepare data ---
 
@@ -312,7 +327,337 @@ app.layout = html.Div(style={
 ])
 
 
-# --- 3. callback functions for plot and table updates ---
+# --- 3. cache for computed callback outputs ---
+
+# backend selection via environment: 'sqlite' (shared by all workers on a host), 'memory' or 'none'
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite')
+CACHE_PATH = os.environ.get('CACHE_PATH', os.path.join(BASE_DIR, 'cache', 'callbacks.sqlite'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+def compute_cache_version():
+    """Hash the data files and library versions so cached outputs are invalidated when either changes."""
+    digest = hashlib.sha256()
+    # serialized figures and components depend on the libraries that created them
+    for version in [platform.python_version(), pd.__version__, plotly.__version__, dash.__version__]:
+        digest.update(version.encode())
+    for path in [PYRAMID_DATA_PATH, AGESTATS_DATA_PATH, PYRAMID_DESTATIS_PATH,
+                 AGESTATS_DESTATIS_PATH, SIMULATIONS_META_PATH]:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+class NullCache:
+    """Cache backend that stores nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+class MemoryCache:
+    """In-process cache backend with size-bounded LRU eviction."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.total_bytes = 0
+        # callbacks may run concurrently in threads (threaded dev server, gunicorn gthread)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            blob = self.entries.pop(key, None)
+            if blob is None:
+                return None
+            self.entries[key] = blob  # re-insert to mark as recently used
+            return blob
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.total_bytes += len(value)
+            while self.total_bytes > self.max_bytes and self.entries:
+                oldest = next(iter(self.entries))
+                self.total_bytes -= len(self.entries.pop(oldest))
+
+class SQLiteCache:
+    """On-disk cache backend shared by all processes on a host, with size-bounded LRU eviction."""
+
+    # only refresh an entry's access time for LRU eviction if it is older than this (in seconds)
+    touch_interval = 60
+
+    def __init__(self, path, max_bytes, version):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # workers started at the same time all run this setup, so wait for the lock and retry
+        # instead of giving up on the shared cache at the first contention
+        for attempt in range(5):
+            conn = self._connect(timeout=10.0)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                with conn:
+                    conn.execute('DROP TABLE IF EXISTS entries')  # pickle-based layout of earlier versions
+                    # value is stored last so size and access time can be read without touching the blob
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS outputs ('
+                        'key TEXT PRIMARY KEY, version TEXT, size INTEGER, accessed REAL, value BLOB)'
+                    )
+                    conn.execute('CREATE INDEX IF NOT EXISTS outputs_accessed ON outputs (accessed)')
+                    # running total of stored bytes, so writes don't have to sum over the whole table
+                    conn.execute('CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)')
+                    # drop entries computed from older data files or libraries
+                    conn.execute('DELETE FROM outputs WHERE version != ?', (version,))
+                    conn.execute(
+                        'INSERT OR REPLACE INTO usage (id, total) '
+                        'SELECT 0, COALESCE(SUM(size), 0) FROM outputs'
+                    )
+                break
+            except sqlite3.OperationalError:
+                if attempt == 4:
+                    raise
+                time.sleep(0.5)
+            finally:
+                conn.close()
+
+    def _connect(self, timeout=5.0):
+        # a fresh connection per call keeps the backend safe across forked gunicorn workers
+        conn = sqlite3.connect(self.path, timeout=timeout)
+        # in WAL mode this stays safe against corruption and avoids an fsync on every commit
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            return None
+        try:
+            # WAL readers never wait for writers, so the lookup itself is not blocked by other workers
+            row = conn.execute(
+                'SELECT value, accessed FROM outputs WHERE key = ? AND version = ?', (key, self.version)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.touch_interval:
+                # best-effort access time update, skipped if another worker holds the write lock
+                try:
+                    conn.execute('PRAGMA busy_timeout = 50')
+                    with conn:
+                        conn.execute('UPDATE outputs SET accessed = ? WHERE key = ?', (now, key))
+                except sqlite3.Error:
+                    pass
+            return row[0]
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
+    def set(self, key, value):
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            return
+        try:
+            with conn:
+                # take the write lock up front so the running total stays consistent across workers
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT size FROM outputs WHERE key = ?', (key,)).fetchone()
+                conn.execute(
+                    'INSERT OR REPLACE INTO outputs (key, version, size, accessed, value) VALUES (?, ?, ?, ?, ?)',
+                    (key, self.version, len(value), time.time(), value)
+                )
+                total = conn.execute('SELECT total FROM usage WHERE id = 0').fetchone()[0]
+                total += len(value) - (row[0] if row is not None else 0)
+                if total > self.max_bytes:
+                    # evict least recently used entries until the cache fits its budget again;
+                    # the cursor walks the accessed index lazily and stops as soon as enough is freed
+                    stale = []
+                    for stale_key, size in conn.execute('SELECT key, size FROM outputs ORDER BY accessed'):
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((stale_key,))
+                        total -= size
+                    conn.executemany('DELETE FROM outputs WHERE key = ?', stale)
+                conn.execute('UPDATE usage SET total = ? WHERE id = 0', (total,))
+        except sqlite3.Error:
+            pass  # a busy or broken cache must never fail a callback
+        finally:
+            conn.close()
+
+def build_cache():
+    """Create the cache backend configured via CACHE_BACKEND."""
+    if CACHE_BACKEND == 'none':
+        return NullCache()
+    if CACHE_BACKEND == 'memory':
+        return MemoryCache(CACHE_MAX_BYTES)
+    if CACHE_BACKEND == 'sqlite':
+        try:
+            return SQLiteCache(CACHE_PATH, CACHE_MAX_BYTES, cache_version)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: could not open cache at {CACHE_PATH}, falling back to in-memory cache ({e}).")
+            return MemoryCache(CACHE_MAX_BYTES)
+    raise ValueError(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}', expected 'sqlite', 'memory' or 'none'.")
+
+cache_version = compute_cache_version()
+callback_cache = build_cache()
+
+def cached_output(func):
+    """Serve a callback's output from the cache, keyed by cache version, callback name and inputs.
+
+    Outputs are stored as the JSON Dash sends to the browser and returned in that decoded form,
+    so a tampered or corrupted cache file can at worst yield a wrong figure, never run code.
+    The returned wrapper's `refresh` attribute recomputes and stores the output without reading the cache.
+    """
+    def refresh(*args):
+        result = func(*args)
+        key = f"{cache_version}:{func.__name__}:{json.dumps(args)}"
+        callback_cache.set(key, json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder).encode())
+        return result
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = f"{cache_version}:{func.__name__}:{json.dumps(args)}"
+        blob = callback_cache.get(key)
+        if blob is not None:
+            try:
+                return json.loads(blob)
+            except ValueError:
+                pass  # corrupted entry, recompute instead
+        return refresh(*args)
+
+    wrapper.refresh = refresh
+    return wrapper
+
+
+# --- 4. on-demand profiling of callbacks ---
+
+# the profiler is only installed when PROFILE_DIR is set; otherwise callbacks run unwrapped.
+# set it at deploy time: profiling is then switched on at runtime via the token header or the
+# sample_rate file, while setting PROFILE_DIR later requires a restart
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+# requests sending this value in the X-Profile-Token header are always profiled
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+# 'sample' writes collapsed stacks (*.folded) for flamegraph.pl/speedscope, 'cprofile' writes pstats (*.prof)
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.001))
+
+if PROFILE_DIR and PROFILE_MODE not in ('sample', 'cprofile'):
+    raise ValueError(f"Unknown PROFILE_MODE '{PROFILE_MODE}', expected 'sample' or 'cprofile'.")
+
+# only one cProfile profiler can be active per process (enforced from Python 3.12 on)
+cprofile_lock = threading.Lock()
+
+# share of requests to profile, read from PROFILE_DIR/sample_rate so it can be changed without a restart
+profile_rate_path = os.path.join(PROFILE_DIR, 'sample_rate') if PROFILE_DIR else None
+profile_rate = 0.0
+profile_rate_checked = 0.0
+
+def read_profile_rate():
+    """Return the current sampling rate, re-reading the control file at most every 5 seconds."""
+    global profile_rate, profile_rate_checked
+    now = time.monotonic()
+    if now - profile_rate_checked >= 5:
+        profile_rate_checked = now
+        try:
+            with open(profile_rate_path) as f:
+                profile_rate = min(max(float(f.read().strip() or 0), 0.0), 1.0)
+        except (OSError, ValueError):
+            profile_rate = 0.0
+    return profile_rate
+
+def should_profile():
+    """Decide whether the current request is profiled, by admin header or by sampling."""
+    token = request.headers.get('X-Profile-Token')
+    if PROFILE_TOKEN and token and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+        return True
+    rate = read_profile_rate()
+    return rate > 0 and random.random() < rate
+
+def sample_stacks(thread_id, stop_event, counts):
+    """Periodically record the call stack of the given thread as collapsed stack strings."""
+    while not stop_event.is_set():
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        stop_event.wait(PROFILE_SAMPLE_INTERVAL)
+
+def profiled(func):
+    """Write a profile of the callback to PROFILE_DIR for requests selected by should_profile()."""
+    if not PROFILE_DIR:
+        return func
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+    except OSError as e:
+        print(f"Warning: could not create profile directory {PROFILE_DIR}, profiling disabled ({e}).")
+        return func
+
+    # profiled requests bypass the cache read so the profile shows the actual computation
+    target = getattr(func, 'refresh', func)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not should_profile():
+            return func(*args)
+
+        # file name carries callback, inputs and process so slow scenario/year combinations are easy to find;
+        # inputs come from the client, so only short alphanumeric parts are kept
+        inputs = '_'.join(
+            re.sub(r'[^A-Za-z0-9]+', '', str(arg))[:32] for arg in args if isinstance(arg, (str, int, float))
+        )
+        basename = (
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{func.__name__}-{inputs}-{os.getpid()}-{random.getrandbits(32):08x}"
+        )
+
+        if PROFILE_MODE == 'cprofile':
+            if not cprofile_lock.acquire(blocking=False):
+                return func(*args)  # another thread is being profiled, run this one unprofiled
+            try:
+                profiler = cProfile.Profile()
+                result = profiler.runcall(target, *args)
+            finally:
+                cprofile_lock.release()
+            try:
+                profiler.dump_stats(os.path.join(PROFILE_DIR, f"{basename}.prof"))
+            except (OSError, ValueError) as e:
+                print(f"Warning: could not write profile {basename}.prof ({e}).")
+            return result
+
+        counts = collections.Counter()
+        stop_event = threading.Event()
+        sampler = threading.Thread(
+            target=sample_stacks, args=(threading.get_ident(), stop_event, counts), daemon=True
+        )
+        sampler.start()
+        try:
+            result = target(*args)
+        finally:
+            stop_event.set()
+            sampler.join()
+        # the profiler is optional, so a failed write must never fail the callback
+        try:
+            with open(os.path.join(PROFILE_DIR, f"{basename}.folded"), 'w') as f:
+                for stack, count in counts.items():
+                    f.write(f"{stack} {count}\n")
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not write profile {basename}.folded ({e}).")
+        return result
+    return wrapper
+
+
+# --- 5. callback functions for plot and table updates ---
 
 @app.callback(
     Output('year-interval', 'disabled'),
@@ -348,6 +693,7 @@ def toggle_play_pause(play_clicks, pause_clicks):
     State('year-slider', 'min'),
     State('year-slider', 'max')
 )
+@profiled
 def update_year_slider(benchmark_mode, history_mode, n_intervals, current_value, slider_min, slider_max):
     """Update the year slider's min, max, marks, and value based on modes and interval."""
     benchmark_on = 'on' in (benchmark_mode or [])
@@ -409,6 +755,8 @@ def update_current_year_display(selected_year):
         Input('history-toggle', 'value')
     ]
 )
+@profiled
+@cached_output
 def update_pyramid_figure(g_val, l_val, w_val, selected_year, benchmark_mode, history_mode):
     """Update the population pyramid figure based on selected scenario, year, and modes."""
     if selected_year is None:
@@ -526,6 +874,8 @@ def update_pyramid_figure(g_val, l_val, w_val, selected_year, benchmark_mode, hi
      Input('benchmark-toggle', 'value'),
      Input('history-toggle', 'value')]
 )
+@profiled
+@cached_output
 def update_tables(g_val, l_val, w_val, selected_year, benchmark_mode, historical_mode):
     """Update the statistics table based on selected scenario, year, and modes."""
     if selected_year is None:
@@ -690,7 +1040,7 @@ def update_tables(g_val, l_val, w_val, selected_year, benchmark_mode, historical
     return html.Table(table_header + [html.Tbody(table_rows)], style=table_style)
 
 
-# --- 4. run the app (only locally) ---
+# --- 6. run the app (only locally) ---
 if __name__ == '__main__':
     app.run(debug=True)
 